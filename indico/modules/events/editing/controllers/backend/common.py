@@ -7,13 +7,17 @@
 
 from flask import jsonify, request, session
 
-from indico.core import signals
 from indico.modules.events.editing.controllers.base import RHEditableTypeEditorBase, RHEditingBase
 from indico.modules.events.editing.models.editable import EditableType
 from indico.modules.events.editing.models.file_types import EditingFileType
 from indico.modules.events.editing.schemas import EditingFileTypeSchema, EditingMenuItemSchema, EditingTagSchema
 from indico.modules.events.editing.settings import editable_type_settings
-from indico.util.signals import named_objects_from_signal
+from indico.modules.events.editing.util import get_editing_menu_items
+
+
+file_types_schema = EditingFileTypeSchema(many=True)
+tags_schema = EditingTagSchema(many=True)
+menu_items_schema = EditingMenuItemSchema(many=True)
 
 
 class RHEditingFileTypes(RHEditingBase):
@@ -27,7 +31,7 @@ class RHEditingFileTypes(RHEditingBase):
         self.editing_file_types = EditingFileType.query.with_parent(self.event).filter_by(type=self.editable_type).all()
 
     def _process(self):
-        return EditingFileTypeSchema(many=True).jsonify(self.editing_file_types)
+        return file_types_schema.jsonify(self.editing_file_types)
 
 
 class RHEditingTags(RHEditingBase):
@@ -36,24 +40,22 @@ class RHEditingTags(RHEditingBase):
     SERVICE_ALLOWED = True
 
     def _process(self):
-        return EditingTagSchema(many=True).jsonify(self.event.editing_tags)
+        return tags_schema.jsonify(self.event.editing_tags)
 
 
 class RHMenuEntries(RHEditingBase):
     """Return the menu entries for the editing view."""
 
     def _process(self):
-        menu_entries = sorted(
-            named_objects_from_signal(signals.menu.items.send('event-editing-sidemenu', event=self.event)).values(),
-            key=lambda x: (-x.weight, x.title),
-        )
+        menu_entries = get_editing_menu_items(self.event)
         is_editing_manager = self.event.can_manage(session.user, permission='editing_manager')
-        show_editable_list = {
-            et.name: (is_editing_manager or self.event.can_manage(session.user, et.editor_permission))
-            for et in EditableType
-        }
+        if is_editing_manager:
+            show_editable_list = {et.name: True for et in EditableType}
+        else:
+            show_editable_list = {et.name: self.event.can_manage(session.user, et.editor_permission)
+                                  for et in EditableType}
         return jsonify(
-            items=EditingMenuItemSchema(many=True).dump(menu_entries),
+            items=menu_items_schema.dump(menu_entries),
             show_management_link=is_editing_manager,
             show_editable_list=show_editable_list
         )
@@ -5,6 +5,10 @@
 # modify it under the terms of the MIT License; see the
 # LICENSE file for more details.
 
+from indico.core import signals
+from indico.util.signals import named_objects_from_signal
+
+
 def get_editors(event, editable_type):
     """Get all users who are editors in the event.
 
@@ -17,3 +21,11 @@ def get_editors(event, editable_type):
             continue
         users.update(principal.get_users())
     return users
+
+
+def get_editing_menu_items(event):
+    """Get the sorted items of the editing side menu of the event."""
+    return sorted(
+        named_objects_from_signal(signals.menu.items.send('event-editing-sidemenu', event=event)).values(),
+        key=lambda x: (-x.weight, x.title),
+    )
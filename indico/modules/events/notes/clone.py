@@ -20,6 +20,10 @@ class NoteCloner(EventCloner):
     friendly_name = _('Minutes')
     uses = {'sessions', 'contributions'}
 
+    def __init__(self, old_event, n_occurrence=0):
+        super().__init__(old_event, n_occurrence)
+        self._has_content_cache = {}
+
     @property
     def is_available(self):
         return self._has_content(self.old_event)
@@ -43,13 +47,16 @@ class NoteCloner(EventCloner):
         db.session.flush()
         if event_exists:
             for note in self._note_map.values():
-                if note in self._restored_notes:
+                if note.id in self._restored_notes:
                     signals.event.notes.note_restored.send(note)
                 else:
                     signals.event.notes.note_added.send(note)
 
     def _has_content(self, event):
-        return event.all_notes.filter_by(is_deleted=False).has_rows()
+        # availability is checked several times while preparing the cloning operation
+        if event.id not in self._has_content_cache:
+            self._has_content_cache[event.id] = event.all_notes.filter_by(is_deleted=False).has_rows()
+        return self._has_content_cache[event.id]
 
     def _query_notes(self):
         return (self.old_event.all_notes
@@ -57,7 +64,7 @@ class NoteCloner(EventCloner):
                 .filter(EventNote.link_type.in_([LinkType.session, LinkType.contribution, LinkType.subcontribution]))
                 .options(joinedload('session'),
                          joinedload('contribution'),
-                         joinedload('subcontribution'),
+                         joinedload('subcontribution').joinedload('contribution'),
                          joinedload('current_revision').joinedload('user')))
 
     def _clone_notes(self, new_event):
@@ -77,7 +84,8 @@ class NoteCloner(EventCloner):
 
     def _clone_note(self, old_note, new_object):
         revision = old_note.current_revision
-        self._note_map[old_note] = note = EventNote.get_or_create(new_object)
+        self._note_map[old_note.id] = note = EventNote.get_or_create(new_object)
         if note.is_deleted:
-            self._restored_notes.add(note)
+            # deleted notes already exist in the database so they have an id
+            self._restored_notes.add(note.id)
         note.create_revision(render_mode=revision.render_mode, source=revision.source, user=revision.user)
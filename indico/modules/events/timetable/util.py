@@ -7,14 +7,15 @@
 
 from collections import defaultdict
 from dataclasses import dataclass
+from datetime import date, timedelta
 from io import BytesIO
-from itertools import groupby
+from itertools import chain
 from operator import attrgetter
 
 from flask import render_template, session
 from pytz import utc
-from sqlalchemy import Date, cast
-from sqlalchemy.orm import contains_eager, joinedload, subqueryload, undefer
+from sqlalchemy.orm import contains_eager, joinedload, selectinload, subqueryload, undefer
+from sqlalchemy.orm.attributes import set_committed_value
 from weasyprint import CSS, HTML
 
 from indico.core.db import db
@@ -24,7 +25,6 @@ from indico.modules.events.models.persons import EventPersonLink
 from indico.modules.events.sessions.models.blocks import SessionBlock
 from indico.modules.events.sessions.models.sessions import Session
 from indico.modules.events.timetable.legacy import TimetableSerializer, serialize_event_info
-from indico.modules.events.timetable.models.breaks import Break
 from indico.modules.events.timetable.models.entries import TimetableEntry, TimetableEntryType
 from indico.modules.receipts.util import sandboxed_url_fetcher
 from indico.util.caching import memoize_request
@@ -34,41 +34,56 @@ from indico.web.flask.templating import get_template_module
 from indico.web.forms.colors import get_colors
 
 
-def _query_events(categ_ids, day_start, day_end):
-    event = db.aliased(Event)
+def _query_events(categ_ids, day_start, day_end, from_categ=None):
     dates_overlap = lambda t: (t.start_dt >= day_start) & (t.start_dt <= day_end)
-    return (db.session.query(Event.id, TimetableEntry.start_dt)
-            .filter(
-                Event.category_chain_overlaps(categ_ids),
-                ~Event.is_deleted,
-                ((Event.timetable_entries.any(dates_overlap(TimetableEntry))) |
-                 (Event.query.exists().where(
-                     Event.happens_between(day_start, day_end) &
-                     (Event.id == event.id)))))
-            .group_by(Event.id, TimetableEntry.start_dt)
-            .order_by(Event.id, TimetableEntry.start_dt)
-            .join(TimetableEntry,
-                  (TimetableEntry.event_id == Event.id) & (dates_overlap(TimetableEntry)),
-                  isouter=True))
-
-
-def _query_blocks(event_ids, dates_overlap, detail_level='session'):
-    options = [subqueryload('session').joinedload('blocks').joinedload('person_links')]
-
-    if detail_level == 'contribution':
-        options.append(contains_eager(SessionBlock.timetable_entry).joinedload(TimetableEntry.children))
-    else:
-        options.append(contains_eager(SessionBlock.timetable_entry))
-
+    criteria = [Event.category_chain_overlaps(categ_ids), ~Event.is_deleted]
+    if from_categ:
+        criteria.append(Event.is_visible_in(from_categ.id))
+    # events with timetable entries in the interval
+    scheduled = (db.select([Event.id.label('event_id'), TimetableEntry.start_dt.label('start_dt')])
+                 .select_from(Event)
+                 .join(TimetableEntry, (TimetableEntry.event_id == Event.id) & dates_overlap(TimetableEntry))
+                 .where(*criteria))
+    # events taking place in the interval but without any timetable entries in it; the
+    # NOT EXISTS is what keeps the two branches disjoint, so an event never has both
+    # dated rows and a NULL row (which the caller relies on)
+    unscheduled = (db.select([Event.id.label('event_id'), db.null().label('start_dt')])
+                   .where(*criteria,
+                          Event.happens_between(day_start, day_end),
+                          ~Event.timetable_entries.any(dates_overlap(TimetableEntry))))
+    # only the ids and start times are needed, so we use a plain select which
+    # does not involve the ORM when loading the results
+    subquery = db.union_all(scheduled, unscheduled).subquery()
+    query = (db.select([subquery.c.event_id, subquery.c.start_dt])
+             .distinct()
+             .order_by(subquery.c.event_id, subquery.c.start_dt))
+    return db.session.execute(query)
+
+
+def _query_blocks(event_ids, dates_overlap):
     return (SessionBlock.query
             .filter(~Session.is_deleted,
                     Session.event_id.in_(event_ids),
                     dates_overlap(TimetableEntry))
-            .options(*options)
+            .options(subqueryload('session').joinedload('blocks').joinedload('person_links'),
+                     contains_eager(SessionBlock.timetable_entry))
             .join(TimetableEntry)
             .join(Session))
 
 
+def _query_entries(event_ids, dates_overlap):
+    """Query all timetable entries together with their blocks, contributions and breaks."""
+    block_strategy = joinedload(TimetableEntry.session_block)
+    block_strategy.subqueryload('session').joinedload('blocks').joinedload('person_links')
+    return (TimetableEntry.query
+            .filter(TimetableEntry.event_id.in_(event_ids),
+                    dates_overlap(TimetableEntry))
+            .options(block_strategy,
+                     joinedload(TimetableEntry.contribution).selectinload(Contribution.person_links),
+                     joinedload(TimetableEntry.break_),
+                     selectinload(TimetableEntry.children)))
+
+
 def find_latest_entry_end_dt(obj, day=None):
     """Get the latest end datetime for timetable entries within the object.
 
@@ -84,8 +99,11 @@ def find_latest_entry_end_dt(obj, day=None):
             raise ValueError('No day specified for event.')
         if not (obj.start_dt_local.date() <= day <= obj.end_dt_local.date()):
             raise ValueError('Day out of event bounds.')
+        day_start = get_day_start(day, tzinfo=obj.tzinfo)
+        next_day_start = get_day_start(day + timedelta(days=1), tzinfo=obj.tzinfo)
         entries = obj.timetable_entries.filter(TimetableEntry.parent_id.is_(None),
-                                               cast(TimetableEntry.start_dt.astimezone(obj.tzinfo), Date) == day).all()
+                                               TimetableEntry.start_dt >= day_start,
+                                               TimetableEntry.start_dt < next_day_start).all()
     elif isinstance(obj, SessionBlock):
         if day is not None:
             raise ValueError('Day specified for session block.')
@@ -159,18 +177,21 @@ def get_category_timetable(categ_ids, start_dt, end_dt, detail_level='event', tz
     day_end = end_dt.astimezone(utc)
     dates_overlap = lambda t: (t.start_dt >= day_start) & (t.start_dt <= day_end)
 
-    items = defaultdict(lambda: defaultdict(list))
+    items = {}
 
     # first of all, query TimetableEntries/events that fall within
     # specified range of dates (and category set)
-    events = _query_events(categ_ids, day_start, day_end)
-    if from_categ:
-        events = events.filter(Event.is_visible_in(from_categ.id))
+    events = _query_events(categ_ids, day_start, day_end, from_categ)
     for eid, tt_start_dt in events:
+        # _query_events never returns both a NULL row and dated rows for the same event,
+        # but if it did, the timetable entries take precedence
         if tt_start_dt:
-            items[eid][tt_start_dt.astimezone(tz).date()].append(tt_start_dt)
+            event_items = items.get(eid)
+            if event_items is None:
+                items[eid] = event_items = {}
+            event_items.setdefault(tt_start_dt.astimezone(tz).date(), []).append(tt_start_dt)
         else:
-            items[eid] = None
+            items.setdefault(eid, None)
 
     # then, retrieve detailed information about the events
     event_ids = set(items)
@@ -208,9 +229,10 @@ def get_category_timetable(categ_ids, start_dt, end_dt, detail_level='event', tz
     # result[event_id]['contribs'][date(...)] -> [(TimetableEntry(...), Contribution(...))]
     # result['ongoing_events'] = [Event(...)]
     if grouped:
-        result = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+        result = defaultdict(lambda: {'blocks': defaultdict(list), 'contribs': defaultdict(list),
+                                      'breaks': defaultdict(list)})
     else:
-        result = defaultdict(lambda: defaultdict(list))
+        result = defaultdict(lambda: {'blocks': [], 'contributions': [], 'breaks': []})
 
     result.update({
         'events': scheduled_events if grouped else events,
@@ -218,8 +240,8 @@ def get_category_timetable(categ_ids, start_dt, end_dt, detail_level='event', tz
     })
 
     # according to detail level, ask for extra information from the DB
-    if detail_level != 'event':
-        query = _query_blocks(event_ids, dates_overlap, detail_level)
+    if detail_level == 'session':
+        query = _query_blocks(event_ids, dates_overlap)
         if grouped:
             for b in query:
                 start_date = b.timetable_entry.start_dt.astimezone(tz).date()
@@ -227,34 +249,30 @@ def get_category_timetable(categ_ids, start_dt, end_dt, detail_level='event', tz
         else:
             for b in query:
                 result[b.session.event_id]['blocks'].append(b)
-
-    if detail_level == 'contribution':
-        query = (Contribution.query
-                 .filter(Contribution.event_id.in_(event_ids),
-                         dates_overlap(TimetableEntry),
-                         ~Contribution.is_deleted)
-                 .options(contains_eager(Contribution.timetable_entry),
-                          joinedload(Contribution.person_links))
-                 .join(TimetableEntry))
-        if grouped:
-            for c in query:
-                start_date = c.timetable_entry.start_dt.astimezone(tz).date()
-                result[c.event_id]['contribs'][start_date].append((c.timetable_entry, c))
-        else:
-            for c in query:
-                result[c.event_id]['contributions'].append(c)
-
-        query = (Break.query
-                 .filter(TimetableEntry.event_id.in_(event_ids), dates_overlap(TimetableEntry))
-                 .options(contains_eager(Break.timetable_entry))
-                 .join(TimetableEntry))
-        if grouped:
-            for b in query:
-                start_date = b.timetable_entry.start_dt.astimezone(tz).date()
-                result[b.timetable_entry.event_id]['breaks'][start_date].append((b.timetable_entry, b))
-        else:
-            for b in query:
-                result[b.timetable_entry.event_id]['breaks'].append(b)
+    elif detail_level == 'contribution':
+        # get blocks, contributions and breaks in a single query
+        for entry in _query_entries(event_ids, dates_overlap):
+            if entry.type == TimetableEntryType.SESSION_BLOCK:
+                obj = entry.session_block
+                if obj.session.is_deleted:
+                    continue
+                key = grouped_key = 'blocks'
+            elif entry.type == TimetableEntryType.CONTRIBUTION:
+                obj = entry.contribution
+                if obj.is_deleted:
+                    continue
+                key, grouped_key = 'contributions', 'contribs'
+            else:
+                obj = entry.break_
+                key = grouped_key = 'breaks'
+            # the objects are loaded through the entry, so the backref to it is not
+            # populated, but it is used everywhere when displaying the timetable
+            set_committed_value(obj, 'timetable_entry', entry)
+            if grouped:
+                start_date = entry.start_dt.astimezone(tz).date()
+                result[entry.event_id][grouped_key][start_date].append((entry, obj))
+            else:
+                result[entry.event_id][key].append(obj)
     return result
 
 
@@ -293,8 +311,11 @@ def render_session_timetable(session, timetable_layout=None, management=False):
 
 def get_session_block_entries(event, day):
     """Return a list of event top-level session blocks for the given `day`."""
+    day_start = get_day_start(day.date(), tzinfo=event.tzinfo)
+    next_day_start = get_day_start(day.date() + timedelta(days=1), tzinfo=event.tzinfo)
     return (event.timetable_entries
-            .filter(db.cast(TimetableEntry.start_dt.astimezone(event.tzinfo), db.Date) == day.date(),
+            .filter(TimetableEntry.start_dt >= day_start,
+                    TimetableEntry.start_dt < next_day_start,
                     TimetableEntry.type == TimetableEntryType.SESSION_BLOCK)
             .all())
 
@@ -303,15 +324,25 @@ def shift_following_entries(entry, shift, session_=None):
     """Reschedule entries starting after the given entry by the given shift."""
     query = entry.siblings_query.filter(TimetableEntry.start_dt >= entry.end_dt)
     if session_ and not entry.parent:
-        query.filter(TimetableEntry.type == TimetableEntryType.SESSION_BLOCK,
-                     TimetableEntry.session_block.has(session_id=session_.id))
-    entries = query.all()
+        query = query.filter(TimetableEntry.type == TimetableEntryType.SESSION_BLOCK,
+                             TimetableEntry.session_block.has(session_id=session_.id))
+    # the entries need to be moved one by one so time change tracking picks them up,
+    # but we preload the children of session blocks to avoid a query for each block
+    entries = query.options(selectinload('children')).all()
     if not entries:
         return []
     for sibling in entries:
         sibling.move(sibling.start_dt + shift)
 
 
+_TIME_CHANGE_MESSAGES = {
+    (Event, 'start_dt'): _('Event start time changed to {}'),
+    (Event, 'end_dt'): _('Event end time changed to {}'),
+    (SessionBlock, 'start_dt'): _('Session block start time changed to {}'),
+    (SessionBlock, 'end_dt'): _('Session block end time changed to {}'),
+}
+
+
 def get_time_changes_notifications(changes, tzinfo, entry=None):
     notifications = []
     for obj, change in changes.items():
@@ -320,27 +351,19 @@ def get_time_changes_notifications(changes, tzinfo, entry=None):
                 continue
             if not isinstance(obj, Event) and obj.timetable_entry in entry.children:
                 continue
-        msg = None
         if isinstance(obj, Event):
-            if 'start_dt' in change:
-                new_time = change['start_dt'][1]
-                msg = _('Event start time changed to {}')
-            elif 'end_dt' in change:
-                new_time = change['end_dt'][1]
-                msg = _('Event end time changed to {}')
-            else:
-                raise ValueError('Invalid change in event.')
+            cls = Event
         elif isinstance(obj, SessionBlock):
-            if 'start_dt' in change:
-                new_time = change['start_dt'][1]
-                msg = _('Session block start time changed to {}')
-            elif 'end_dt' in change:
-                new_time = change['end_dt'][1]
-                msg = _('Session block end time changed to {}')
-            else:
-                raise ValueError('Invalid change in session block.')
-        if msg:
-            notifications.append(msg.format(format_time(new_time, timezone=tzinfo)))
+            cls = SessionBlock
+        else:
+            continue
+        for field in ('start_dt', 'end_dt'):
+            if field in change:
+                msg = _TIME_CHANGE_MESSAGES[cls, field]
+                notifications.append(msg.format(format_time(change[field][1], timezone=tzinfo)))
+                break
+        else:
+            raise ValueError(f'Invalid change in {cls.__name__}.')
     return notifications
 
 
@@ -354,59 +377,76 @@ def get_nested_timetable(event, *, include_notes=True, show_date='all', show_ses
     event.preload_all_acl_entries()
     event_tz = event.display_tzinfo
 
-    children_strategy = joinedload('children')
-    children_strategy.joinedload('session_block').joinedload('person_links')
+    # collections are loaded using selectin queries to avoid a huge cartesian product
+    # in the joins, while many-to-one relationships are still joined directly
+    children_strategy = selectinload('children')
+    children_strategy.joinedload('session_block').selectinload('person_links')
     children_strategy.joinedload('break_')
 
-    children_contrib_strategy = children_strategy.subqueryload('contribution')
-    children_contrib_strategy.joinedload('person_links')
-    children_contrib_strategy.joinedload('subcontributions')
-    children_contrib_strategy.joinedload('references')
+    children_contrib_strategy = children_strategy.joinedload('contribution')
+    children_contrib_strategy.selectinload('person_links')
+    children_contrib_strategy.selectinload('references')
     children_contrib_strategy.joinedload('own_room')
 
-    children_subcontrib_strategy = children_contrib_strategy.joinedload('subcontributions')
-    children_subcontrib_strategy.joinedload('person_links')
-    children_subcontrib_strategy.joinedload('references')
+    children_subcontrib_strategy = children_contrib_strategy.selectinload('subcontributions')
+    children_subcontrib_strategy.selectinload('person_links')
+    children_subcontrib_strategy.selectinload('references')
 
     contrib_strategy = joinedload('contribution')
-    contrib_strategy.joinedload('person_links')
-    contrib_strategy.joinedload('references')
+    contrib_strategy.selectinload('person_links')
+    contrib_strategy.selectinload('references')
 
-    subcontrib_strategy = contrib_strategy.joinedload('subcontributions')
-    subcontrib_strategy.joinedload('person_links')
-    subcontrib_strategy.joinedload('references')
+    subcontrib_strategy = contrib_strategy.selectinload('subcontributions')
+    subcontrib_strategy.selectinload('person_links')
+    subcontrib_strategy.selectinload('references')
 
     if include_notes:
         children_contrib_strategy.joinedload('note')
+        children_subcontrib_strategy.joinedload('note')
         contrib_strategy.joinedload('note')
         subcontrib_strategy.joinedload('note')
 
     # try to minimize the number of DB queries
     options = [contrib_strategy,
                children_strategy,
-               joinedload('session_block').joinedload('person_links'),
+               joinedload('session_block').selectinload('person_links'),
                joinedload('session_block').joinedload('own_room'),
                joinedload('break_')]
 
+    day_start = next_day_start = None
+    if show_date != 'all':
+        try:
+            day = date.fromisoformat(show_date)
+        except ValueError:
+            return []
+        if day.isoformat() != show_date:
+            return []
+        # compare against the boundaries of the local day instead of converting each entry's start time
+        day_start = get_day_start(day, tzinfo=event_tz)
+        next_day_start = get_day_start(day + timedelta(days=1), tzinfo=event_tz)
+
+    user = session.user
+    show_contributions = detail_level in ('contribution', 'all') and show_session == 'all'
     entries = []
 
     for entry in event.timetable_entries.filter_by(parent=None).options(*options):
-        if show_date != 'all' and entry.start_dt.astimezone(event_tz).date().isoformat() != show_date:
+        if day_start is not None and not (day_start <= entry.start_dt < next_day_start):
             continue
-        if (entry.type == TimetableEntryType.CONTRIBUTION and
-                (detail_level not in ('contribution', 'all') or show_session != 'all')):
+        entry_type = entry.type
+        if entry_type == TimetableEntryType.BREAK:
+            entries.append(entry)
             continue
-        elif (entry.type == TimetableEntryType.SESSION_BLOCK and show_session != 'all' and
-                str(entry.object.session.friendly_id) != show_session):
+        obj = entry.object
+        if entry_type == TimetableEntryType.CONTRIBUTION and not show_contributions:
             continue
-
-        if entry.type == TimetableEntryType.BREAK:
-            entries.append(entry)
-        elif entry.object.can_access(session.user):
+        elif (entry_type == TimetableEntryType.SESSION_BLOCK and show_session != 'all' and
+                str(obj.session.friendly_id) != show_session):
+            continue
+        if obj.can_access(user):
             entries.append(entry)
 
-    entries.sort(key=attrgetter('end_dt'), reverse=True)
-    entries.sort(key=lambda entry: (entry.start_dt, *_entry_title_key(entry)))
+    # entries starting at the same time are ordered by title, and then by end time (latest first)
+    entries.sort(key=lambda entry: (entry.start_dt, *_entry_title_key(entry), -entry.end_dt.timestamp()))
 
     return entries
 
@@ -415,20 +455,16 @@ def get_nested_timetable_location_conditions(entries):
     show_siblings_location = False
     show_children_location = {}
 
-    show_siblings_location = any(
-        not entry.object.inherit_location or (
-            # the object is a session block and inherits from a session with a custom location
-            entry.type == TimetableEntryType.SESSION_BLOCK
-            and entry.object.inherit_location
-            and not entry.object.session.inherit_location
-        )
-        for entry in entries
-    )
-
-    show_children_location = {
-        entry.id: not all(child.object.inherit_location for child in entry.children)
-        for entry in entries
-    }
+    for entry in entries:
+        obj = entry.object
+        if not show_siblings_location:
+            show_siblings_location = not obj.inherit_location or (
+                # the object is a session block and inherits from a session with a custom location
+                entry.type == TimetableEntryType.SESSION_BLOCK
+                and obj.inherit_location
+                and not obj.session.inherit_location
+            )
+        show_children_location[entry.id] = not all(child.object.inherit_location for child in entry.children)
 
     return show_siblings_location, show_children_location
 
@@ -460,13 +496,10 @@ def create_pdf(html, css, event) -> BytesIO:
     css_url_fetcher = sandboxed_url_fetcher(event)
     html_url_fetcher = sandboxed_url_fetcher(event, allow_event_images=True)
     css = CSS(string=css, url_fetcher=css_url_fetcher)
-    documents = [
-        HTML(string=html, url_fetcher=html_url_fetcher).render(stylesheets=(css,))
-    ]
-    all_pages = [p for doc in documents for p in doc.pages]
+    document = HTML(string=html, url_fetcher=html_url_fetcher).render(stylesheets=(css,))
 
     f = BytesIO()
-    documents[0].copy(all_pages).write_pdf(f)
+    document.write_pdf(f)
     f.seek(0)
 
     return f
@@ -479,15 +512,19 @@ def generate_pdf_timetable(
     only_session: Session | None = None,
 ):
     css = render_template('events/timetable/pdf/timetable.css')
-    entries = get_nested_timetable(event)
-    if only_session:
-        entries = [
-            e for e in entries
-            if e.type == TimetableEntryType.SESSION_BLOCK and e.session_block.session == only_session
-        ]
-
-    days = {day: list(e) for day, e in groupby(entries, lambda e: e.start_dt.astimezone(event.tzinfo).date())}
-    show_siblings_location, show_children_location = get_nested_timetable_location_conditions(entries)
+    tzinfo = event.tzinfo
+    # the template iterates over the days multiple times, so we need lists here, but
+    # we can filter and group the entries (already sorted by start time) in one go
+    days = {}
+    for entry in get_nested_timetable(event):
+        if only_session and (entry.type != TimetableEntryType.SESSION_BLOCK or
+                             entry.session_block.session != only_session):
+            continue
+        days.setdefault(entry.start_dt.astimezone(tzinfo).date(), []).append(entry)
+
+    show_siblings_location, show_children_location = get_nested_timetable_location_conditions(
+        chain.from_iterable(days.values())
+    )
     program_config = TimetableExportProgramConfig(
         show_siblings_location=bool(show_siblings_location or only_session),
         show_children_location=show_children_location
@@ -5,12 +5,14 @@
 # modify it under the terms of the MIT License; see the
 # LICENSE file for more details.
 
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 
 import pytest
 from pytz import utc
 
-from indico.modules.events.timetable.util import find_latest_entry_end_dt
+from indico.modules.events.timetable.models.breaks import Break
+from indico.modules.events.timetable.util import (_query_events, find_latest_entry_end_dt, get_category_timetable,
+                                                  shift_following_entries)
 
 
 @pytest.mark.parametrize(('event_start_dt', 'event_end_dt', 'day', 'valid'), (
@@ -27,3 +29,107 @@ def test_find_latest_entry_end_dt_valid_day(dummy_event, event_start_dt, event_e
     if not valid:
         with pytest.raises(ValueError):
             find_latest_entry_end_dt(obj=dummy_event, day=day)
+
+
+def test_shift_following_entries_session(db, dummy_event, create_session, create_session_block):
+    dummy_event.start_dt = datetime(2016, 1, 2, 8, 0, tzinfo=utc)
+    dummy_event.end_dt = datetime(2016, 1, 2, 18, 0, tzinfo=utc)
+    session_a = create_session(dummy_event, 'A')
+    session_b = create_session(dummy_event, 'B')
+    block_a1 = create_session_block(session_a, 'A1', timedelta(hours=1), datetime(2016, 1, 2, 9, 0, tzinfo=utc))
+    block_b = create_session_block(session_b, 'B', timedelta(hours=1), datetime(2016, 1, 2, 10, 0, tzinfo=utc))
+    block_a2 = create_session_block(session_a, 'A2', timedelta(hours=1), datetime(2016, 1, 2, 11, 0, tzinfo=utc))
+    shift_following_entries(block_a1.timetable_entry, timedelta(minutes=30), session_=session_a)
+    assert block_a2.timetable_entry.start_dt == datetime(2016, 1, 2, 11, 30, tzinfo=utc)
+    assert block_b.timetable_entry.start_dt == datetime(2016, 1, 2, 10, 0, tzinfo=utc)
+
+
+@pytest.mark.parametrize('grouped', (True, False))
+def test_get_category_timetable_contributions(db, dummy_category, dummy_event, create_session, create_session_block,
+                                              create_contribution, create_timetable_entry, count_queries, grouped):
+    dummy_event.start_dt = datetime(2016, 1, 2, 8, 0, tzinfo=utc)
+    dummy_event.end_dt = datetime(2016, 1, 2, 18, 0, tzinfo=utc)
+    block = create_session_block(create_session(dummy_event, 'S'), 'Block', timedelta(hours=1),
+                                 datetime(2016, 1, 2, 9, 0, tzinfo=utc))
+    deleted_session = create_session(dummy_event, 'Deleted', is_deleted=True)
+    create_session_block(deleted_session, 'Deleted block', timedelta(hours=1), datetime(2016, 1, 2, 10, 0, tzinfo=utc))
+    contrib = create_contribution(dummy_event, 'Contribution')
+    create_timetable_entry(dummy_event, contrib, datetime(2016, 1, 2, 11, 0, tzinfo=utc))
+    deleted_contrib = create_contribution(dummy_event, 'Deleted contribution', is_deleted=True)
+    create_timetable_entry(dummy_event, deleted_contrib, datetime(2016, 1, 2, 12, 0, tzinfo=utc))
+    break_ = Break(title='Break', duration=timedelta(minutes=30))
+    create_timetable_entry(dummy_event, break_, datetime(2016, 1, 2, 13, 0, tzinfo=utc))
+    db.session.flush()
+    event_id = dummy_event.id
+    db.session.expire_all()
+
+    result = get_category_timetable([dummy_category.id], datetime(2016, 1, 2, tzinfo=utc),
+                                    datetime(2016, 1, 2, 23, 59, tzinfo=utc), detail_level='contribution',
+                                    grouped=grouped)
+    day = date(2016, 1, 2)
+    if grouped:
+        blocks = [obj for entry, obj in result[event_id]['blocks'][day]]
+        contribs = [obj for entry, obj in result[event_id]['contribs'][day]]
+        breaks = [obj for entry, obj in result[event_id]['breaks'][day]]
+        assert all(entry.object == obj
+                   for key in ('blocks', 'contribs', 'breaks')
+                   for entry, obj in result[event_id][key][day])
+    else:
+        blocks = result[event_id]['blocks']
+        contribs = result[event_id]['contributions']
+        breaks = result[event_id]['breaks']
+    assert blocks == [block]
+    assert contribs == [contrib]
+    assert breaks == [break_]
+    # the backref to the timetable entry is used when displaying the objects
+    with count_queries() as cnt:
+        start_dts = {obj.title: obj.timetable_entry.start_dt for obj in (*blocks, *contribs, *breaks)}
+    assert cnt() == 0
+    assert start_dts == {'Block': datetime(2016, 1, 2, 9, 0, tzinfo=utc),
+                         'Contribution': datetime(2016, 1, 2, 11, 0, tzinfo=utc),
+                         'Break': datetime(2016, 1, 2, 13, 0, tzinfo=utc)}
+
+
+def test_query_events(db, dummy_category, create_event, create_contribution, create_timetable_entry):
+    day_start = datetime(2016, 1, 2, tzinfo=utc)
+    day_end = datetime(2016, 1, 2, 23, 59, tzinfo=utc)
+    # event with entries in the interval
+    scheduled = create_event(1, start_dt=datetime(2016, 1, 2, 8, 0, tzinfo=utc),
+                             end_dt=datetime(2016, 1, 2, 18, 0, tzinfo=utc))
+    for hour in (9, 10):
+        create_timetable_entry(scheduled, create_contribution(scheduled, f'Contribution {hour}'),
+                               datetime(2016, 1, 2, hour, 0, tzinfo=utc))
+    # event spanning the interval without any entries in it
+    unscheduled = create_event(2, start_dt=datetime(2016, 1, 1, 8, 0, tzinfo=utc),
+                               end_dt=datetime(2016, 1, 5, 18, 0, tzinfo=utc))
+    create_timetable_entry(unscheduled, create_contribution(unscheduled, 'Contribution'),
+                           datetime(2016, 1, 1, 9, 0, tzinfo=utc))
+    # event spanning the interval which also has entries in it
+    spanning = create_event(3, start_dt=datetime(2016, 1, 1, 8, 0, tzinfo=utc),
+                            end_dt=datetime(2016, 1, 5, 18, 0, tzinfo=utc))
+    create_timetable_entry(spanning, create_contribution(spanning, 'Contribution'),
+                           datetime(2016, 1, 2, 11, 0, tzinfo=utc))
+    # event not happening in the interval
+    create_event(4, start_dt=datetime(2016, 1, 3, 8, 0, tzinfo=utc), end_dt=datetime(2016, 1, 3, 18, 0, tzinfo=utc))
+    db.session.flush()
+
+    rows = {tuple(row) for row in _query_events([dummy_category.id], day_start, day_end)}
+    assert rows == {
+        (scheduled.id, datetime(2016, 1, 2, 9, 0, tzinfo=utc)),
+        (scheduled.id, datetime(2016, 1, 2, 10, 0, tzinfo=utc)),
+        (unscheduled.id, None),
+        (spanning.id, datetime(2016, 1, 2, 11, 0, tzinfo=utc)),
+    }
+
+
+def test_query_events_visibility(db, dummy_category, create_event):
+    day_start = datetime(2016, 1, 2, tzinfo=utc)
+    day_end = datetime(2016, 1, 2, 23, 59, tzinfo=utc)
+    visible = create_event(1, start_dt=datetime(2016, 1, 2, 8, 0, tzinfo=utc),
+                           end_dt=datetime(2016, 1, 2, 18, 0, tzinfo=utc))
+    hidden = create_event(2, start_dt=datetime(2016, 1, 2, 8, 0, tzinfo=utc),
+                          end_dt=datetime(2016, 1, 2, 18, 0, tzinfo=utc), visibility=0)
+    db.session.flush()
+    assert {row[0] for row in _query_events([dummy_category.id], day_start, day_end)} == {visible.id, hidden.id}
+    assert {row[0] for row in _query_events([dummy_category.id], day_start, day_end,
+                                            from_categ=dummy_category)} == {visible.id}